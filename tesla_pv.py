@@ -9,32 +9,136 @@ Description
 @note:  All rights reserved.
 """
 import os
+import random
+import re
 import numpy as np
 import teslapy
 import json
 import requests
 import sys
 import signal
+import threading
 import time
 
+from collections import deque
 from datetime import datetime, timedelta
-from math import ceil, floor
-from typing import List, Dict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from math import ceil
+from typing import Callable, List, Dict, NamedTuple, Optional, Tuple
 from dataclasses import dataclass
 
+try:
+    # optional, parses the response bytes directly and faster than the json module
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# a refresh within this many seconds means another caller just rotated the token
+MIN_REFRESH_INTERVAL = 30.0
+# refresh the access token this many seconds before it expires
+TOKEN_EXPIRY_MARGIN = 60.0
+# seconds to back off after a 429 response that does not say for how long
+DEFAULT_BAN_TIME = 60.0
+# upper bound in seconds for the random delay added on top of a ban
+MAX_BAN_JITTER = 60.0
+RETRY_IN_PATTERN = re.compile(r"Retry in (\d+) seconds")
+# the vehicle listing rarely changes, its online state is re-checked by sync_wake_up anyway
+VEHICLE_TTL = 600.0
+# initial number of samples the power history can hold before it has to grow
+INITIAL_SAMPLES = 256
+# upper bound in seconds for the poll interval while nothing is to be adapted
+MAX_POLL_TIME = 300
+
 
 def log(message: str):
     print(f"{str(datetime.now())}: {message}")
 
 
+def _retry_after(response) -> Optional[float]:
+    # seconds the Tesla API asks us to wait, None if the response is no rate limit
+    if response is None:
+        return None
+    header = response.headers.get('Retry-After', '')
+    if header.isdigit():
+        return float(header)
+    match = RETRY_IN_PATTERN.search(response.text)
+    if match:
+        return float(match.group(1))
+    if response.status_code == 429:
+        return DEFAULT_BAN_TIME
+    return None
+
+
+class BannedError(Exception):
+    def __init__(self, banned_until: float):
+        super().__init__(f"rate limited by the Tesla API for another {banned_until - time.monotonic():.0f} s")
+        self.banned_until = banned_until
+
+    def remaining(self) -> float:
+        return max(0.0, self.banned_until - time.monotonic())
+
+
+class ChargeState(NamedTuple):
+    soc: float
+    current_amperage: float
+    current_charge_power: float
+    charge_limit_soc: float
+    charge_current_request: int
+
+
 class TeslaApi:
-    def __init__(self, email: str, token: str):
+    def __init__(self, email: str, token: str, token_dumper: Optional[Callable[[str], None]] = None,
+                 ttls: Optional[Dict[str, float]] = None):
         self.tesla = teslapy.Tesla(email)
         self.token = token
+        self.token_dumper = token_dumper
+        self._refresh_lock = threading.Lock()
+        self._last_refresh_ts = float('-inf')
+        self._token_expires_at = 0.0
+        self._banned_until = 0.0
+        if self.tesla.authorized:
+            self._update_token_expiry()
+        # seconds a result of call() stays valid per endpoint, endpoints without a ttl are never cached;
+        # only calls without arguments are cached, arguments like a vehicle are not hashable
+        self.ttls = ttls or dict()
+        self._cache = dict()
+        # the endpoints reachable through call()
+        self._dispatch = {
+            'vehicle': self._vehicle,
+            'vehicle_data': self._vehicle_data,
+            'charge_state': self._charge_state,
+            'battery_data': self._battery_data,
+            'wake_up': self._wake_up,
+            'command': self._command,
+        }
 
     def _vehicle(self):
         return self.tesla.vehicle_list()[0]
         
+    def _vehicle_data(self, vehicle, endpoints: str = "charge_state"):
+        # only request the needed parts of the vehicle data in a single round-trip
+        data = vehicle.api('VEHICLE_DATA', endpoints = endpoints)['response']
+        vehicle.update(data)
+        # the response includes the online state, so sync_wake_up does not need to fetch a summary for a while
+        vehicle.timestamp = time.time()
+        return data
+
+    def _wake_up(self, vehicle):
+        vehicle.sync_wake_up()
+
+    def _command(self, vehicle, name: str, **kwargs):
+        return vehicle.command(name, **kwargs)
+
+    def _charge_state(self, vehicle) -> ChargeState:
+        charge_state = self._vehicle_data(vehicle)['charge_state']
+        return ChargeState(
+            soc = float(charge_state["battery_level"]),
+            current_amperage = float(charge_state["charger_actual_current"]),
+            current_charge_power = float(charge_state["charger_power"]),
+            charge_limit_soc = float(charge_state["charge_limit_soc"]),
+            charge_current_request = int(charge_state["charge_current_request"]))
+
     def _battery_data(self):
         powerwall = self.tesla.battery_list()[0]
         return powerwall.get_battery_data()
@@ -42,42 +146,141 @@ class TeslaApi:
     def close(self):
         self.tesla.close()
 
+    def _update_token_expiry(self):
+        # unix time, as stored in the token by oauthlib
+        self._token_expires_at = (self.tesla.expires_at or 0.0) - TOKEN_EXPIRY_MARGIN
+
+    def refresh_token(self):
+        with self._refresh_lock:
+            if time.monotonic() - self._last_refresh_ts < MIN_REFRESH_INTERVAL:
+                return
+            self.tesla.refresh_token(refresh_token = self.token)
+            self._last_refresh_ts = time.monotonic()
+            self._update_token_expiry()
+            # refresh tokens are single-use, keep the rotated one for the next refresh and restart
+            new_token = self.tesla.token.get('refresh_token')
+            if new_token and new_token != self.token:
+                self.token = new_token
+                if self.token_dumper:
+                    self.token_dumper(new_token)
+
     def call(self, name: str, *args, **kwargs):
-        do = f"_{name}"
-        if hasattr(self, do) and callable(func := getattr(self, do)):
+        ttl = self.ttls.get(name)
+        if ttl and not args and not kwargs:
+            cached = self._cache.get(name)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+            value = self._call(name)
+            self._cache[name] = (time.monotonic() + ttl, value)
+            return value
+        return self._call(name, *args, **kwargs)
+
+    def _check_rate_limit(self, e: teslapy.HTTPError):
+        retry_after = _retry_after(e.response)
+        if retry_after is not None:
+            # a little jitter against simultaneous restarts, but never before the time requested by the server
+            jitter = random.uniform(0.0, min(retry_after * 0.5, MAX_BAN_JITTER))
+            self._banned_until = time.monotonic() + retry_after + jitter
+            raise BannedError(self._banned_until) from e
+
+    def _call(self, name: str, *args, **kwargs):
+        # every request during a ban prolongs it, so do not even try
+        if time.monotonic() < self._banned_until:
+            raise BannedError(self._banned_until)
+        if (func := self._dispatch.get(name)) is not None:
             if not self.tesla.authorized:
                 try:
-                    self.tesla.refresh_token(refresh_token = self.token)
+                    self.refresh_token()
+                except Exception as e:
+                    raise Exception("Refreshing the access token failed; is the refresh_token still valid?") from e
+            # refresh ahead of the expiry instead of waiting for the call to fail; the current token still works,
+            # so let network errors and rate limits through to be handled like those of any other request
+            elif time.time() >= self._token_expires_at:
+                try:
+                    self.refresh_token()
+                except teslapy.HTTPError as e:
+                    self._check_rate_limit(e)
+                    raise
+                except requests.exceptions.RequestException:
+                    raise
                 except Exception as e:
                     raise Exception("Refreshing the access token failed; is the refresh_token still valid?") from e
             try:
                 return func(*args, **kwargs)
-            except:
-                self.tesla.refresh_token(refresh_token = self.token)
+            except teslapy.HTTPError as e:
+                self._check_rate_limit(e)
+                status = e.response.status_code if e.response is not None else None
+                # only an authentication failure warrants a new token, e.g. it was revoked or the local clock is off
+                if status == 401:
+                    self.refresh_token()
+                # a server error is worth one more try; an asleep or unavailable vehicle (408) is not, the next
+                # cycle wakes it up
+                elif not (status and status >= 500):
+                    raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                pass
+            try:
                 return func(*args, **kwargs)
+            except teslapy.HTTPError as e:
+                self._check_rate_limit(e)
+                raise
         else:
-            raise Exception(f"No method {do} found")
+            raise Exception(f"No endpoint {name} found")
+
+
+@dataclass
+class PowerStats:
+    values: np.ndarray
+    pmax: float
+    # (index, power) pairs with decreasing power, the first one at or after an index is the maximum from there on
+    max_candidates: List[Tuple[int, int]]
+
+    def strip(self, count: int) -> 'PowerStats':
+        if count >= len(self.values):
+            raise ValueError(f"cannot strip {count} of {len(self.values)} samples")
+        candidates = [(index - count, power) for index, power in self.max_candidates if index >= count]
+        return PowerStats(self.values[count:], float(candidates[0][1]), candidates)
 
 
 class HistoricData:
     def __init__(self):
         self.timestamp = None
-        self.power_history = None
+        self._buf = np.empty(INITIAL_SAMPLES, dtype = np.int32)
+        self._n = 0
+        self.max_candidates = None
         self.car = dict()
         self.check_period_minutes = 0.5
         self.reset()
 
     def reset(self):
-        self.power_history = list()
+        self._n = 0
+        # (index, power) pairs with decreasing power, the head is the maximum of the current period
+        self.max_candidates = deque()
         self.timestamp = datetime.now()
 
-    def add(self, power: int) -> List[int]:
-        self.power_history.append(power)
-        if (datetime.now() - self.timestamp > timedelta(minutes = self.check_period_minutes) and len(self.power_history) > 10):
-            history = self.power_history
+    def add(self, power: int) -> Optional[PowerStats]:
+        while self.max_candidates and power >= self.max_candidates[-1][1]:
+            self.max_candidates.pop()
+        self.max_candidates.append((self._n, power))
+        if self._n == len(self._buf):
+            self._buf = np.concatenate((self._buf, np.empty_like(self._buf)))
+        self._buf[self._n] = power
+        self._n += 1
+        if (datetime.now() - self.timestamp > timedelta(minutes = self.check_period_minutes) and self._n > 10):
+            # copy, the buffer is overwritten by the next period
+            stats = PowerStats(self._buf[:self._n].copy(), float(self.max_candidates[0][1]), list(self.max_candidates))
             self.reset()
-            return history
-        return list()
+            return stats
+        return None
+
+
+def _compute_new_amperage(pmax: float, effective_voltage: float, current_amperage: float,
+                          min_amperage: int) -> Tuple[float, int, bool]:
+    # returns (new_charge_power, new_amperage, new_do_charging) for the maximum grid power of a period
+    # -max(history - charge power) == charge power - max(history), no shifted copy of the history is needed
+    new_charge_power = effective_voltage * current_amperage - pmax
+    possible_amperage = int(new_charge_power // effective_voltage)
+    return new_charge_power, max(possible_amperage, min_amperage), possible_amperage >= min_amperage
 
 
 @dataclass
@@ -95,55 +298,72 @@ class ChargeControl:
         self.do_not_interfere_charge_limit_soc = int(options['DO_NOT_INTERFERE_CHARGE_LIMIT'])
         self.do_not_interfere_amperage = int(options['DO_NOT_INTERFERE_AMPERAGE'])
         self.min_amperage = int(options['MIN_AMPERAGE'])
-        self.effective_voltage = int(options['EFFECTIVE_VOLTAGE'])
+        # 0 means estimating the voltage from the reported charge power and current
+        self.effective_voltage = float(options['EFFECTIVE_VOLTAGE'])
+        self.estimated_voltage = 3.0 * 230.0
         self.change_of_charge_power = False
 
-    def set_charging(self, vehicle, start):
+    def _estimate_voltage(self, power: float, amperage: float) -> float:
+        # keep the last estimate while not charging, the number of phases does not change in between
+        if amperage > 0:
+            self.estimated_voltage = max(230.0, round(power * 1000.0 / amperage / 230.0) * 230.0)
+        return self.estimated_voltage
+
+    def set_charging(self, vehicle, start, already_awake = False):
         log(f"start charging: {start}")
-        vehicle.sync_wake_up()
+        if not already_awake:
+            self.api.call('wake_up', vehicle)
         try:
             if start:
-                vehicle.command('START_CHARGE')
+                self.api.call('command', vehicle, 'START_CHARGE')
             else:
-                vehicle.command('STOP_CHARGE')
+                self.api.call('command', vehicle, 'STOP_CHARGE')
+        except BannedError:
+            raise
         except Exception as e:
-            log(f"could not {action} charging: {e}".format(action="start" if start else "stop"))
-
-    def set_charge_speed(self, vehicle, amperage):
-        vehicle.sync_wake_up()
-        # after the wakeup, the current charge state becomes queryable
-        cur_amps = vehicle["charge_state"]["charge_current_request"]
+            action = "start" if start else "stop"
+            log(f"could not {action} charging: {e}")
+
+    def set_charge_speed(self, vehicle, amperage, charge_state: Optional[ChargeState] = None):
+        if charge_state is None:
+            self.api.call('wake_up', vehicle)
+            # after the wakeup, the current charge state becomes queryable
+            charge_state = self.api.call('charge_state', vehicle)
+        cur_amps = charge_state.charge_current_request
         if cur_amps < self.do_not_interfere_amperage and \
                 cur_amps != amperage:
             log(f"set amperage {amperage} (was {cur_amps})")
             try:
-                vehicle.command("CHARGING_AMPS", charging_amps = amperage)
+                self.api.call('command', vehicle, "CHARGING_AMPS", charging_amps = amperage)
                 self.change_of_charge_power = True
                 log(f"amperage set")
+            except BannedError:
+                raise
             except Exception as e:
                 log(f"could not set amperage to {amperage}: {e}")
 
     # returns a tuple (vehicle_is_charging, soc_min_reached, soc_limit_reached)
-    def update_charge_speed(self, power_history: np.array) -> (bool, bool, bool):
+    def update_charge_speed(self, power_stats: PowerStats) -> (bool, bool, bool):
         vehicle = self.api.call('vehicle')
-        vehicle.sync_wake_up()
-        # after the wakeup, the current charge state becomes queryable
-        soc = float(vehicle["charge_state"]["battery_level"])
-        current_amperage = float(vehicle["charge_state"]["charger_actual_current"])
-        current_charge_power = float(vehicle["charge_state"]["charger_power"])
-        charge_limit_soc = float(vehicle["charge_state"]["charge_limit_soc"])
+        self.api.call('wake_up', vehicle)
+        # after the wakeup, the current charge state becomes queryable; the vehicle is cached, so fetch it explicitly
+        charge_state = self.api.call('charge_state', vehicle)
+        soc = charge_state.soc
+        current_amperage = charge_state.current_amperage
+        current_charge_power = charge_state.current_charge_power
+        charge_limit_soc = charge_state.charge_limit_soc
         currently_charging = current_charge_power > 0.1
         soc_min_reached = soc >= self.empty_soc
         soc_limit_reached = soc >= charge_limit_soc
         
         # strip first 10 seconds after power change as the charger needs to ramp up (to avoid oszillation)
         if self.change_of_charge_power:
-            log(f"strip first seconds because we lately changed the charging speed size: {len(power_history)}")
+            log(f"strip first seconds because we lately changed the charging speed size: {len(power_stats.values)}")
             self.change_of_charge_power = False
             try:
-                power_history = power_history[10:]
+                power_stats = power_stats.strip(10)
             except:
-                log(f"power history was too short, could not strip first 10s: {len(power_history)}")
+                log(f"power history was too short, could not strip first 10s: {len(power_stats.values)}")
 
         log(f"current amperage: {current_amperage} A")
         log(f"current charge limit: {int(charge_limit_soc)}%")
@@ -157,73 +377,105 @@ class ChargeControl:
             log(f"charge with {new_amperage} A since SOC is below {self.empty_soc}")
             new_do_charging = True
         else:
-            effective_voltage = self.effective_voltage
-            if not effective_voltage:
-                try:
-                    effective_voltage = round(current_charge_power * 1000.0 / current_amperage / 230.0) * 230.0
-                except ZeroDivisionError:
-                    effective_voltage = 230.0 * 3.0
-                effective_voltage = max(230.0, effective_voltage)
-            else:
-                effective_voltage = 3.0 * 230.0
-
-            consumption_history = power_history - effective_voltage * current_amperage
+            effective_voltage = self.effective_voltage or self._estimate_voltage(current_charge_power, current_amperage)
 
             # calculate optimal charge power based on current soc
-            if abs(np.max(power_history)) < 50:        # hysteresis
-                log(f"deviation too small - keeping old chargespeed max: {np.max(power_history)}")
+            if abs(power_stats.pmax) < 50:        # hysteresis
+                log(f"deviation too small - keeping old chargespeed max: {power_stats.pmax}")
                 return ChargeControlResult(currently_charging, soc_min_reached, soc_limit_reached)
-            new_charge_power = -np.max(consumption_history)
-            new_amperage = floor(new_charge_power / effective_voltage)
-            log(f"chargepower: {new_charge_power} W => {new_amperage} A")
-            if new_amperage < self.min_amperage:
-                new_amperage = self.min_amperage
-                new_do_charging = False
-            else:
-                new_do_charging = True
+            new_charge_power, new_amperage, new_do_charging = _compute_new_amperage(
+                power_stats.pmax, effective_voltage, current_amperage, self.min_amperage)
+            log(f"chargepower: {new_charge_power} W => {new_amperage} A, charging: {new_do_charging}")
 
         if currently_charging != new_do_charging:
-            self.set_charging(vehicle, new_do_charging)
-        if new_do_charging:
-            new_amperage = max(new_amperage, self.min_amperage)
-            if new_amperage != current_amperage:
-                self.set_charge_speed(vehicle, new_amperage)
+            self.set_charging(vehicle, new_do_charging, already_awake = True)
+        if new_do_charging and new_amperage != current_amperage:
+            self.set_charge_speed(vehicle, new_amperage, charge_state)
         return ChargeControlResult(new_do_charging, soc_min_reached, soc_limit_reached)
 
 if __name__ == '__main__':
-    with open("options.json", "r") as fp:
-        options = json.load(fp)
+    with open("options.json", "rb") as fp:
+        options = json_loads(fp.read())
 
     twc_vitals_url = 'http://' + options['TWC_IP_ADDRESS']+ '/api/1/vitals'
     poll_time = int(options['POLL_TIME'])
 
-    tesla_api = TeslaApi(options['TESLA_MAIL'], options['TESLA_TOKEN'])
+    def save_refresh_token(token: str):
+        # the old refresh token is dead by now, so never leave a truncated options.json behind
+        try:
+            with open("options.json.tmp", "w") as fp:
+                json.dump({**options, 'TESLA_TOKEN': token}, fp, indent=4)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace("options.json.tmp", "options.json")
+        except OSError as e:
+            log(f"could not store rotated refresh token in options.json: {e}")
+            return
+        options['TESLA_TOKEN'] = token
+        log("stored rotated refresh token in options.json")
+
+    ttls = {'vehicle': VEHICLE_TTL}
+    tesla_api = TeslaApi(options['TESLA_MAIL'], options['TESLA_TOKEN'], save_refresh_token, ttls)
     historic_data = HistoricData()
     charge_control = ChargeControl(tesla_api, options)
     adapt_charge_speed = True
+    current_interval = poll_time
+    last_state = None
+    session = requests.Session()
+    # keep a single connection to the TWC open and retry short outages with an exponential backoff
+    session.mount('http://', HTTPAdapter(pool_connections = 1, pool_maxsize = 1,
+                                         max_retries = Retry(total = 3, backoff_factor = 1)))
 
     def signal_handler(signal, frame):
         tesla_api.close()
+        session.close()
         print("\nprogram exiting gracefully")
         sys.exit(0)
 
     signal.signal(signal.SIGINT, signal_handler)
 
+    def wait_for_ban(e: BannedError):
+        log(f"{e}, pausing")
+        time.sleep(e.remaining())
+
     while True:
-        twc_vitals = json.loads(requests.get(twc_vitals_url).content.decode('UTF-8'))
+        try:
+            twc_vitals = json_loads(session.get(twc_vitals_url, timeout = 5).content)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            log(f"could not reach the wall connector: {e}")
+            time.sleep(current_interval)
+            continue
 
         vehicle_connected = twc_vitals['vehicle_connected']
-        battery_data = tesla_api.call('battery_data')
-        grid_power = int(battery_data['power_reading'][0]['grid_power'])
-        solar_power = int(battery_data['power_reading'][0]['solar_power'])
+        # grid and solar power are only of interest while the vehicle is connected
+        if vehicle_connected:
+            try:
+                battery_data = tesla_api.call('battery_data')
+            except BannedError as e:
+                wait_for_ban(e)
+                continue
+            except requests.exceptions.RequestException as e:
+                log(f"could not fetch the battery data: {e}")
+                time.sleep(current_interval)
+                continue
+            grid_power = int(battery_data['power_reading'][0]['grid_power'])
+            solar_power = int(battery_data['power_reading'][0]['solar_power'])
 
         # try to adapt the charge speed if the vehicle is connected and we should adapt the charge speed
         if vehicle_connected and adapt_charge_speed:
             log("vehicle is connected, adding current grid power to history")
-            power_history = historic_data.add(grid_power)
-            if (len(power_history) > 0):
+            power_stats = historic_data.add(grid_power)
+            if power_stats is not None:
                 log("trying to adapt charging speed")
-                result = charge_control.update_charge_speed(np.array(power_history))
+                try:
+                    result = charge_control.update_charge_speed(power_stats)
+                except BannedError as e:
+                    wait_for_ban(e)
+                    continue
+                except (requests.exceptions.RequestException, teslapy.VehicleError) as e:
+                    log(f"could not adapt the charging speed: {e}")
+                    time.sleep(current_interval)
+                    continue
                 # disable charge adaption when the SOC limit is reached
                 if not result.vehicle_is_charging and result.soc_limit_reached:
                     log("vehicle is no longer charging and car SOC limit has been reached, stop polling")
@@ -241,4 +493,13 @@ if __name__ == '__main__':
             log("vehicle not connected, enable adapting charge speed again")
             adapt_charge_speed = True
 
-        time.sleep(poll_time)
+        # poll the battery data slower while the connected vehicle sleeps without solar power, react quickly again on
+        # any change; while disconnected only the local TWC is polled, so keep noticing a plug-in within poll_time
+        state = (vehicle_connected, adapt_charge_speed)
+        if state != last_state:
+            current_interval = poll_time
+        elif vehicle_connected and not adapt_charge_speed and solar_power == 0:
+            current_interval = min(current_interval * 2, max(MAX_POLL_TIME, poll_time))
+        last_state = state
+
+        time.sleep(current_interval)